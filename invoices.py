@@ -2,19 +2,31 @@ import yaml
 from dataclasses import dataclass, field, asdict
 from collections import defaultdict
 import os
-from datetime import datetime
+from datetime import datetime, date
 import argparse
-import json
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from functools import lru_cache
+from typing import Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
+import orjson
 import shutil
-from jinja2 import Environment, FileSystemLoader
-import pdfkit
+import zipfile
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+# Use the libyaml bindings when PyYAML was built with them
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 
 
 DATA_PATH = "data"
 CONFIG_DATA_PATH = f"{DATA_PATH}/config"
 TEMPLATES_DATA_PATH = f"{DATA_PATH}/templates"
+JINJA_CACHE_PATH = f"{DATA_PATH}/.jinja_cache"
 
 CONSULTANT_FILE = "consultant.yaml"
 SERVICES_FILE = "services.yaml"
@@ -30,17 +42,24 @@ OUTPUT_PDF_FOLDER = f"{DATA_PATH}/invoices"
 OUTPUT_PDF_FILE = "invoice_{}.pdf"
 
 HISTORY_DATA_PATH = f"{DATA_PATH}/history"
-HISTORY_FILE = "history.json"
+HISTORY_FILE = "history.jsonl"
+LEGACY_HISTORY_FILE = "history.json"
 
 BACKUP_DATA_PATH = f"{DATA_PATH}/backup"
 BACKUP_FILE_PREFIX = "backup_"
 
 BASE_CURRENCY = "USD"
 CONVERT_API = f"https://api.frankfurter.app"
+RATES_CACHE_FILE = f"{DATA_PATH}/.rates_cache.json"
+CONVERT_API_TIMEOUT = 5
+
+# Shared HTTP session, so currency lookups reuse the same keep-alive connection
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=8))
 
 
 
-@dataclass
+@dataclass(slots=True)
 class Service:
     """Service information"""
     name: str
@@ -66,7 +85,7 @@ class Service:
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class Consultant:
     """Consultant information"""
     name: str
@@ -88,7 +107,7 @@ class Consultant:
         return cls(**data)
 
 
-@dataclass
+@dataclass(slots=True)
 class Client:
     """Client information"""
     full_name: str
@@ -104,13 +123,18 @@ class Client:
         return cls(**data)
 
 
-@dataclass
+@dataclass(slots=True)
 class HistoryEntry:
     """History entry"""
     client_alias: str
     invoice_date: str
     services: list[Service]
 
+    @property
+    def total(self) -> float:
+        """Return the total price of the services"""
+        return sum(service.total for service in self.services)
+
     @classmethod
     def from_dict(cls, data: dict) -> "HistoryEntry":
         """Return a HistoryEntry object from a dictionary"""
@@ -130,7 +154,7 @@ class HistoryEntry:
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class History:
     """History"""
     entries: list[HistoryEntry]
@@ -149,7 +173,7 @@ class History:
         self.entries.append(entry)
 
 
-@dataclass
+@dataclass(slots=True)
 class Invoice:
     """Invoice information"""
     number: int
@@ -159,7 +183,7 @@ class Invoice:
     @property
     def total(self) -> float:
         """Return the total price of the services"""
-        return sum([service.total for service in self.services])
+        return sum(service.total for service in self.services)
 
     def add_service(self, service: Service) -> None:
         """Add a service to the invoice"""
@@ -173,7 +197,7 @@ class ClientNotFoundError(Exception):
 def load_yaml_file(file_path: str) -> dict:
     """Load a yaml file and return the data"""
     with open(file_path, "r") as file:
-        return yaml.safe_load(file)
+        return yaml.load(file, Loader=_SafeLoader)
 
 
 def get_consultant_information() -> Consultant:
@@ -182,19 +206,34 @@ def get_consultant_information() -> Consultant:
     return Consultant.from_dict(consultant_data["consultant"])
 
 
+@lru_cache(maxsize=1)
+def load_clients_by_alias() -> dict[str, Client]:
+    """Load the clients file once and return the clients indexed by alias"""
+    clients_data = load_yaml_file(f"{CONFIG_DATA_PATH}/{CLIENTS_FILE}")
+    return {client["alias"]: Client.from_dict(client) for client in clients_data["clients"]}
+
+
 def get_client_information(client_alias: str) -> Client:
     """Return the client information from the client alias"""
-    clients_data = load_yaml_file(f"{CONFIG_DATA_PATH}/{CLIENTS_FILE}")
-    for client in clients_data["clients"]:
-        if client["alias"] == client_alias:
-            return Client.from_dict(client)
-    raise ClientNotFoundError(f"Client {client_alias} not found")
+    try:
+        return load_clients_by_alias()[client_alias]
+    except KeyError:
+        raise ClientNotFoundError(f"Client {client_alias} not found") from None
+
+
+@lru_cache(maxsize=1)
+def get_jinja_environment() -> Environment:
+    """Return the shared Jinja environment, so the invoice template is only compiled once per process"""
+    # The compiled bytecode is also stored on disk to skip compilation on later runs
+    os.makedirs(JINJA_CACHE_PATH, exist_ok=True)
+    return Environment(loader=FileSystemLoader(TEMPLATES_DATA_PATH),
+                       bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_PATH),
+                       auto_reload=False, cache_size=-1)
 
 
 def render_invoice_template(consultant: Consultant, client: Client, invoice: Invoice) -> str:
     """Render the invoice template with the provided consultant and client information"""
-    env = Environment(loader=FileSystemLoader(f"{TEMPLATES_DATA_PATH}"))
-    template = env.get_template(INVOICE_TEMPLATE_FILE)
+    template = get_jinja_environment().get_template(INVOICE_TEMPLATE_FILE)
     return template.render(consultant=consultant, client=client, invoice=invoice)
 
 
@@ -204,17 +243,23 @@ def save_invoice_to_file(invoice_html: str, file_path: str) -> None:
         file.write(invoice_html)
 
 
-def get_current_invoice_number() -> int:
-    """Read the current invoice_number.txt file"""
-    with open(f"{CONFIG_DATA_PATH}/{INVOICE_NUMBER_FILE}", "r") as file:
-        return int(file.read().strip())
+def update_invoice_number() -> int:
+    """Increment and update the invoice number in the invoice_number.txt file, returning the previous number"""
+    with open(f"{CONFIG_DATA_PATH}/{INVOICE_NUMBER_FILE}", "r+") as file:
+        current_number = int(file.read().strip())
+        file.seek(0)
+        file.truncate()
+        file.write(str(current_number + 1))
+    return current_number
 
 
-def update_invoice_number() -> None:
-    """Increment and update the invoice number in the invoice_number.txt file"""
-    current_number = get_current_invoice_number()
-    with open(f"{CONFIG_DATA_PATH}/{INVOICE_NUMBER_FILE}", "w") as file:
-        file.write(str(current_number + 1))
+def parse_date(date_string: str) -> date:
+    """Parse a YYYY-MM-DD date, also accepting dates that are not zero-padded"""
+    try:
+        return date.fromisoformat(date_string)
+    except ValueError:
+        # Older history entries may hold dates such as 2022-5-1
+        return datetime.strptime(date_string, "%Y-%m-%d").date()
 
 
 def format_current_date() -> str:
@@ -223,42 +268,85 @@ def format_current_date() -> str:
     return today.strftime("%Y-%m-%d")
 
 
+def format_invoice_number(client_short_name: str, invoice_date: str, invoice_number: int) -> str:
+    """Format an invoice number from the client short name, invoice date, and invoice number"""
+    return f"{client_short_name}-{invoice_date}-{invoice_number}"
+
+
 def generate_invoice_number(client_short_name: str, invoice_date: str) -> str:
     """Generate a unique invoice number based on the client alias, current date, and invoice number"""
-    invoice_number = get_current_invoice_number()
-    update_invoice_number()
-    return f"{client_short_name}-{invoice_date}-{invoice_number}"
+    invoice_number = update_invoice_number()
+    return format_invoice_number(client_short_name, invoice_date, invoice_number)
+
+
+def set_invoice_number(invoice_number: int) -> None:
+    """Write the next invoice number to the invoice_number.txt file"""
+    with open(f"{CONFIG_DATA_PATH}/{INVOICE_NUMBER_FILE}", "w") as file:
+        file.write(str(invoice_number))
 
 
 def reset_invoice_number() -> None:
     """Reset the invoice number to 1"""
-    with open(f"{CONFIG_DATA_PATH}/{INVOICE_NUMBER_FILE}", "w") as file:
-        file.write("1")
+    set_invoice_number(1)
 
 
 def save_invoice_to_pdf(invoice_html: str, file_path: str) -> None:
     """Save the rendered invoice HTML to a PDF file"""
-    pdfkit.from_string(invoice_html, file_path)
+    # Imported here as WeasyPrint needs the Pango system library, which commands
+    # that do not render PDFs should not depend on
+    from weasyprint import HTML
+    HTML(string=invoice_html, base_url=TEMPLATES_DATA_PATH).write_pdf(file_path)
 
 
 def load_history() -> History:
     """Load the history file and return the data"""
-    with open(f"{HISTORY_DATA_PATH}/{HISTORY_FILE}", "r") as file:
-        return History.from_dict(json.load(file))
+    history = History(entries=[])
+    with open(f"{HISTORY_DATA_PATH}/{HISTORY_FILE}", "rb") as file:
+        # One entry per line
+        for line in file:
+            if line.strip():
+                history.add_entry(HistoryEntry.from_dict(orjson.loads(line)))
+    return history
+
+
+def iter_history_entries(start_date: date, end_date: date) -> Iterator[HistoryEntry]:
+    """Stream the history file and yield the entries dated within the given range"""
+    with open(f"{HISTORY_DATA_PATH}/{HISTORY_FILE}", "rb") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            # Only build the entries that fall in the range
+            entry_data = orjson.loads(line)
+            if start_date <= parse_date(entry_data["invoice_date"]) <= end_date:
+                yield HistoryEntry.from_dict(entry_data)
 
 
 def append_history(client_alias: str, invoice: Invoice) -> None:
     """Append a new entry to the history file"""
-    history = load_history()
-    history.add_entry(HistoryEntry(
+    entry = HistoryEntry(
         client_alias=client_alias,
         invoice_date=invoice.date,
         services=invoice.services
-    ))
+    )
     print(f"Saving history to {HISTORY_DATA_PATH}/{HISTORY_FILE}")
-    print(f"Added entry: {history.entries[-1]}")
-    with open(f"{HISTORY_DATA_PATH}/{HISTORY_FILE}", "w") as file:
-        json.dump(history.to_dict(), file, indent=4)
+    print(f"Added entry: {entry}")
+    with open(f"{HISTORY_DATA_PATH}/{HISTORY_FILE}", "ab") as file:
+        file.write(orjson.dumps(entry.to_dict()) + b"\n")
+
+
+def migrate_history() -> None:
+    """Convert the legacy history.json file to the line-delimited history file"""
+    legacy_file_path = f"{HISTORY_DATA_PATH}/{LEGACY_HISTORY_FILE}"
+    file_path = f"{HISTORY_DATA_PATH}/{HISTORY_FILE}"
+    if not os.path.exists(legacy_file_path) or os.path.exists(file_path):
+        return
+
+    with open(legacy_file_path, "rb") as file:
+        history = History.from_dict(orjson.loads(file.read()))
+    with open(file_path, "wb") as file:
+        for entry in history.entries:
+            file.write(orjson.dumps(entry.to_dict()) + b"\n")
+    print(f"Migrated history from {legacy_file_path} to {file_path}")
 
 
 def backup_invoices() -> None:
@@ -266,15 +354,41 @@ def backup_invoices() -> None:
     # use timestamp as part of the zip file name
     output_zip = BACKUP_FILE_PREFIX + datetime.now().strftime("%Y%m%d_%H%M%S") + ".zip"
 
-    # Compress the invoice folder if there are any invoices
+    # Archive the whole invoice folder, subfolders included, if there are any invoices
     if os.listdir(OUTPUT_PDF_FOLDER):
-        shutil.make_archive(os.path.join(BACKUP_DATA_PATH,
-                            output_zip), 'zip', OUTPUT_PDF_FOLDER)
+        # PDFs are already compressed, so store them as is instead of deflating them again
+        with zipfile.ZipFile(os.path.join(BACKUP_DATA_PATH, output_zip), "w",
+                             compression=zipfile.ZIP_STORED) as archive:
+            for folder_path, folder_names, file_names in os.walk(OUTPUT_PDF_FOLDER):
+                for name in folder_names + file_names:
+                    path = os.path.join(folder_path, name)
+                    archive.write(path, os.path.relpath(path, OUTPUT_PDF_FOLDER))
 
 def clear_invoices() -> None:
     """Clear the invoices folder"""
-    for file in os.listdir(OUTPUT_PDF_FOLDER):
-        os.remove(os.path.join(OUTPUT_PDF_FOLDER, file))
+    # Subfolders are removed too, backup_invoices archives the whole tree beforehand
+    if os.path.islink(OUTPUT_PDF_FOLDER):
+        # rmtree refuses symlinks, so empty the linked folder and keep the link
+        for entry in os.scandir(OUTPUT_PDF_FOLDER):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+    elif os.path.isdir(OUTPUT_PDF_FOLDER):
+        shutil.rmtree(OUTPUT_PDF_FOLDER)
+    os.makedirs(OUTPUT_PDF_FOLDER, exist_ok=True)
+
+
+def regenerate_invoice(entry: HistoryEntry, consultant: Consultant, client: Client, invoice_number: str) -> None:
+    """Regenerate the invoice PDF for a single history entry"""
+    invoice = Invoice(number=invoice_number, date=entry.invoice_date)
+    for service in entry.services:
+        invoice.add_service(service)
+
+    invoice_html = render_invoice_template(consultant, client, invoice)
+
+    pdf_file_path = f"{OUTPUT_PDF_FOLDER}/{OUTPUT_PDF_FILE.format(invoice.number)}"
+    save_invoice_to_pdf(invoice_html, pdf_file_path)
 
 
 def regenerate_invoices(history: History) -> None:
@@ -282,36 +396,30 @@ def regenerate_invoices(history: History) -> None:
 
     backup_invoices()
     clear_invoices()
-    reset_invoice_number()
 
-    # Recreate the invoices based on the history
-    for entry in history.entries:
-        consultant = get_consultant_information()
-        client = get_client_information(entry.client_alias)
-
-        invoice = Invoice(
-            number=generate_invoice_number(
-                client.short_name, entry.invoice_date),
-            date=entry.invoice_date,
-        )
-        for service in entry.services:
-            invoice.add_service(service)
+    consultant = get_consultant_information()
 
-        invoice_html = render_invoice_template(consultant, client, invoice)
+    # Number the invoices from 1 in the history order, then save the next number once
+    clients = []
+    invoice_numbers = []
+    for invoice_number, entry in enumerate(history.entries, start=1):
+        client = get_client_information(entry.client_alias)
+        clients.append(client)
+        invoice_numbers.append(format_invoice_number(client.short_name, entry.invoice_date, invoice_number))
+    set_invoice_number(len(history.entries) + 1)
 
-        pdf_file_path = f"{OUTPUT_PDF_FOLDER}/{OUTPUT_PDF_FILE.format(invoice.number)}"
-        save_invoice_to_pdf(invoice_html, pdf_file_path)
+    # Recreate the invoices based on the history, each PDF conversion runs in its own process
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(regenerate_invoice, history.entries,
+                          repeat(consultant), clients, invoice_numbers))
 
 
-def convert_currency(amount: float, target_currency: str, conversion_date: str = None) -> float:
-    """Convert the amount to the target currency using an API"""
-    if target_currency == BASE_CURRENCY:
-        return amount
-    
+def fetch_conversion_rate(target_currency: str, conversion_date: str = None) -> float:
+    """Fetch the conversion rate from the base currency to the target currency using an API"""
     # Modify the API request URL to include the date
     historical_api = f"{CONVERT_API}/{conversion_date}?from={BASE_CURRENCY}&to={target_currency}"
 
-    response = requests.get(historical_api)
+    response = _SESSION.get(historical_api, timeout=CONVERT_API_TIMEOUT)
     if response.status_code != 200:
         raise Exception("Failed to fetch currency conversion rates")
 
@@ -319,8 +427,64 @@ def convert_currency(amount: float, target_currency: str, conversion_date: str =
     if target_currency not in rates:
         raise Exception(f"Currency {target_currency} not supported")
 
-    conversion_rate = rates[target_currency]
-    return amount * conversion_rate
+    return rates[target_currency]
+
+
+# Whether rates were fetched during this run that are not in the cache file yet
+_RATES_CACHE_CHANGED = False
+
+
+@lru_cache(maxsize=1)
+def load_rates_cache() -> dict:
+    """Load the conversion rates cache file and return the data"""
+    if not os.path.exists(RATES_CACHE_FILE):
+        return {}
+    with open(RATES_CACHE_FILE, "rb") as file:
+        try:
+            rates_cache = orjson.loads(file.read())
+        except orjson.JSONDecodeError:
+            rates_cache = None
+    # A damaged cache is only a missed optimization, the rates are fetched again
+    return rates_cache if isinstance(rates_cache, dict) else {}
+
+
+def save_rates_cache() -> None:
+    """Save the conversion rates fetched during this run to the cache file"""
+    global _RATES_CACHE_CHANGED
+    if not _RATES_CACHE_CHANGED:
+        return
+
+    # Write to a temporary file first so an interrupted write never leaves a partial cache
+    temporary_file_path = f"{RATES_CACHE_FILE}.tmp"
+    with open(temporary_file_path, "wb") as file:
+        file.write(orjson.dumps(load_rates_cache(), option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    os.replace(temporary_file_path, RATES_CACHE_FILE)
+    _RATES_CACHE_CHANGED = False
+
+
+@lru_cache(maxsize=None)
+def get_conversion_rate(target_currency: str, conversion_date: str = None) -> float:
+    """Return the conversion rate from the base currency to the target currency, fetched once per date"""
+    global _RATES_CACHE_CHANGED
+    # Rates for today or later may still be replaced by the ones published later,
+    # only past rates are final and kept on disk across runs
+    if not conversion_date or parse_date(conversion_date) >= date.today():
+        return fetch_conversion_rate(target_currency, conversion_date)
+
+    rates_cache = load_rates_cache()
+    cache_key = f"{conversion_date}:{BASE_CURRENCY}:{target_currency}"
+    if cache_key not in rates_cache:
+        rates_cache[cache_key] = fetch_conversion_rate(target_currency, conversion_date)
+        _RATES_CACHE_CHANGED = True
+    return rates_cache[cache_key]
+
+
+def convert_currency(amount: float, target_currency: str, conversion_date: str = None) -> float:
+    """Convert the amount to the target currency using an API"""
+    if target_currency == BASE_CURRENCY:
+        return amount
+
+    return amount * get_conversion_rate(target_currency, conversion_date)
 
 
 
@@ -331,13 +495,16 @@ def create_invoice(client_alias: str, services: list[dict], invoice_date: str =
 
     if not invoice_date:
         invoice_date = format_current_date()
+    else:
+        # Store the date in YYYY-MM-DD format, invalid dates fail here rather than in later reports
+        invoice_date = parse_date(invoice_date).isoformat()
 
     # Parse the services input
     invoice = Invoice(number=generate_invoice_number(client.short_name, invoice_date),
                       date=invoice_date)
     for service_input in services:
-        name, rate, units = service_input.split(":")
-        print(name, rate, units)
+        # Split from the right so service names may contain colons
+        name, rate, units = service_input.rsplit(":", 2)
         service = Service(name=name, rate=float(rate), units=int(units))
         invoice.add_service(service)
 
@@ -350,24 +517,23 @@ def create_invoice(client_alias: str, services: list[dict], invoice_date: str =
     append_history(client_alias, invoice)
 
 
-def compute_income(history: History, start_date: str = None, end_date: str = None, currency: str = None) -> None:
+def compute_income(start_date: str = None, end_date: str = None, currency: str = None) -> None:
     """Compute the income for a given date range"""
     if not start_date:
         start_date = "1970-01-01"
     if not end_date:
         end_date = format_current_date()
-    start_date = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date = datetime.strptime(end_date, "%Y-%m-%d")
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
 
     total_income = 0
-    for entry in history.entries:
-        invoice_date = datetime.strptime(entry.invoice_date, "%Y-%m-%d")
-        if start_date <= invoice_date <= end_date:
-            for service in entry.services:
-                if currency:
-                    total_income += convert_currency(service.total, currency, entry.invoice_date)
-                else:
-                    total_income += service.total
+    for entry in iter_history_entries(start_date, end_date):
+        if currency:
+            total_income += convert_currency(entry.total, currency, entry.invoice_date)
+        else:
+            total_income += entry.total
+    if currency:
+        save_rates_cache()
 
     if currency:
         formatted_revenue = currency + " {:,.2f}".format(total_income)
@@ -381,17 +547,18 @@ def summarize_history(history: History, currency: str = None) -> None:
     summary = defaultdict(lambda: defaultdict(float))
 
     for entry in history.entries:
-        invoice_date = datetime.strptime(entry.invoice_date, "%Y-%m-%d")
+        invoice_date = parse_date(entry.invoice_date)
         year = invoice_date.year
         quarter = (invoice_date.month - 1) // 3 + 1
         quarter_key = f"Q{quarter}"
 
-        for service in entry.services:
-            revenue = service.total
-            if currency:
-                revenue = convert_currency(revenue, currency, entry.invoice_date)
-            summary[str(year)][quarter_key] += revenue
-            summary[str(year)]["total"] += revenue
+        revenue = entry.total
+        if currency:
+            revenue = convert_currency(revenue, currency, entry.invoice_date)
+        summary[str(year)][quarter_key] += revenue
+        summary[str(year)]["total"] += revenue
+    if currency:
+        save_rates_cache()
 
     print("Summary of the History:")
     print("-" * 30)
@@ -426,6 +593,7 @@ def main():
     """
 
     ensure_data_paths_exists()
+    migrate_history()
 
     parser = argparse.ArgumentParser(
         description="Invoice Generator and Payment Tracker")
@@ -471,8 +639,7 @@ def main():
         reset_invoice_number()
 
     elif args.command == "compute_income":
-        history = load_history()
-        compute_income(history, args.start_date, args.end_date, args.currency)
+        compute_income(args.start_date, args.end_date, args.currency)
 
     elif args.command == "summarize_history":
         history = load_history()
@@ -481,6 +648,5 @@ def main():
 
 if __name__ == "__main__":
     main()
-    # history = load_history()
-    # compute_income(history, "2022-01-01", None, "EUR")
+    # compute_income("2022-01-01", None, "EUR")
 